@@ -5,6 +5,7 @@ import pandas as pd
 import quandl  # Necessary for obtaining financial data easily
 
 from backtest import Strategy, Portfolio
+from data.cache import cached_download
 
 
 class RandomForecastingStrategy(Strategy):
@@ -14,19 +15,25 @@ class RandomForecastingStrategy(Strategy):
     infrastruttura di backtest!
     """
 
-    def __init__(self, symbol, bars):
-        """Necessita del ticker del simbolo e il dataframe delle barre"""
+    def __init__(self, symbol, bars, seed=None):
+        """
+        Necessita del ticker del simbolo e il dataframe delle barre,
+        il seed opzionale rende riproducibili i segnali random.
+        """
         self.symbol = symbol
         self.bars = bars
+        self._rng = np.random.default_rng(seed)
 
     def generate_signals(self):
         """Creazione del DataFrame pandas dei segnali random."""
         signals = pd.DataFrame(index=self.bars.index)
-        signals['signal'] = np.sign(np.random.randn(len(signals)))
+        # Segnali di +1/-1 generati come int8 dal generatore PCG64
+        signal = self._rng.integers(0, 2, size=len(signals), dtype=np.int8) * 2 - 1
 
         # I primi cinque elementi sono impostati a zero in modo da minimizzare
         # la generazione di errori NaN nella previsione.
-        signals['signal'][0:5] = 0.0
+        signal[0:5] = 0
+        signals['signal'] = signal
         return signals
 
     # random_forecast.py
@@ -62,7 +69,9 @@ class MarketOnOpenPortfolio(Portfolio):
         previsione di {1, 0, -1} dal DataFrame dei segnali.
         """
         positions = pd.DataFrame(index=self.signals.index).fillna(0.0)
-        positions[self.symbol] = 100 * self.signals['signal']
+        # I segnali sono int8: si allarga a int32 prima di moltiplicare
+        # per la quantità di azioni, per evitare l'overflow dell'int8
+        positions[self.symbol] = self.signals['signal'].to_numpy().astype(np.int32) * 100
         return positions
 
 
@@ -80,32 +89,53 @@ class MarketOnOpenPortfolio(Portfolio):
         Restituisce l'oggetto portfolio da utilizzare altrove.
         """
 
-        # Costruzione di un DataFrame 'portfolio' che usa lo stesso indice
-        # delle "posizioni" e con una serie di "ordini di trading"
-        # nell'oggetto 'pos_diff', assumendo prezzi open.
+        # Estrae le posizioni e i prezzi open come array NumPy, in modo
+        # da calcolare il portafoglio senza allineamenti pandas intermedi
+        pos = self.positions[self.symbol].to_numpy(dtype=np.float64)
+        price = self.bars['Open'].to_numpy(dtype=np.float64)
 
-        portfolio = self.positions * self.bars['Open']
-        pos_diff = self.positions.diff()
+        # Crea le serie "holding" e "cash" a partire dagli "ordini di trading",
+        # cioè la differenza delle posizioni tra barre consecutive (la prima
+        # barra acquista l'intera posizione iniziale), assumendo prezzi open
+        delta = np.empty_like(pos)
+        delta[0] = pos[0]
+        delta[1:] = pos[1:] - pos[:-1]
 
-        # Crea le serie "holding" e "cash" scorrendo il dataframe
-        # delle operazioni e aggiungendo / sottraendo la relativa quantità di
-        # ogni colonna
-        portfolio['holdings'] = (self.positions * self.bars['Open']).sum(axis=1)
-        portfolio['cash'] = self.initial_capital - (pos_diff * self.bars['Open']).sum(axis=1).cumsum()
+        # Come con sum(axis=1) di pandas, i prodotti con un prezzo
+        # mancante valgono zero e non si propagano alle barre successive
+        holdings = np.nan_to_num(pos * price, nan=0.0)
+        cash = self.initial_capital - np.nancumsum(delta * price)
 
         # Finalizza i rendimenti totali e basati su barre in base al "contante"
         # e dati sulle "partecipazioni" per il portafoglio
-        portfolio['total'] = portfolio['cash'] + portfolio['holdings']
-        portfolio['returns'] = portfolio['total'].pct_change()
+        total = cash + holdings
+        returns = np.empty_like(total)
+        returns[0] = np.nan
+        returns[1:] = total[1:] / total[:-1] - 1.0
+
+        # Costruzione del DataFrame 'portfolio' con lo stesso indice delle
+        # "posizioni" in un'unica allocazione
+        portfolio = pd.DataFrame({
+            self.symbol: holdings,
+            'holdings': holdings,
+            'cash': cash,
+            'total': total,
+            'returns': returns
+        }, index=self.positions.index)
         return portfolio
 
 
 if __name__ == "__main__":
     # Ottenere le barre giornaliere di SPY (ETF che generalmente
     # segue l'S&P500) da Quandl (richiede 'pip install Quandl'
-    # sulla riga di comando)
+    # sulla riga di comando), salvate in locale dopo il primo download.
+    # La storia scaricata non ha una data di fine, quindi la cache scade
+    # dopo un giorno per includere le nuove barre
     symbol = 'SPY'
-    bars = quandl.get("GOOG/NYSE_%s" % symbol, collapse="daily")
+    bars = cached_download(
+        lambda: quandl.get("GOOG/NYSE_%s" % symbol, collapse="daily"), symbol,
+        ttl=24 * 60 * 60
+    )
 
     # Crea un insieme di segnali randome per SPY
     rfs = RandomForecastingStrategy(symbol, bars)
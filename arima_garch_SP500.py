@@ -9,10 +9,19 @@ import yfinance as yf
 import pandas as pd
 import numpy as np
 
+from data.cache import cached_download
+
 symbol = '^GSPC'
 start = '2000-01-01'
 end = '2018-07-01'
-SP500 = yf.download(symbol, start=start, end=end)
 
-log_ret = np.log(SP500['Adj Close']) - np.log(SP500['Adj Close'].shift(1))
+# Le barre storiche sono scaricate da Yahoo solo alla prima esecuzione,
+# le successive leggono il file Parquet salvato in locale
+SP500 = cached_download(
+    lambda: yf.download(symbol, start=start, end=end), symbol, start, end
+)
+
+# Rendimenti logaritmici calcolati con log1p dei rendimenti percentuali,
+# più stabile vicino allo zero di due np.log e uno shift
+log_ret = np.log1p(SP500['Adj Close'].pct_change())
 print("")
\ No newline at end of file
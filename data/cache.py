@@ -0,0 +1,56 @@
+# cache.py
+
+import os
+import re
+import tempfile
+import time
+
+import pandas as pd
+
+
+def atomic_write(path, write):
+    """
+    Scrive un file passando alla funzione 'write' il percorso di un file
+    temporaneo nella stessa directory, che è poi spostato sul percorso
+    finale con os.replace. Un'esecuzione interrotta o concorrente non
+    lascia mai sul percorso finale un file scritto solo in parte.
+
+    Parametri:
+    path - Il percorso finale del file.
+    write - Funzione che riceve il percorso temporaneo e vi scrive il file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def cached_download(download, symbol, start=None, end=None, cache_dir='.cache', ttl=None):
+    """
+    Restituisce le barre di un simbolo da un file Parquet locale se
+    presente, altrimenti le scarica tramite la funzione 'download' e
+    le salva su disco per le esecuzioni successive.
+
+    Parametri:
+    download - Funzione senza argomenti che scarica e restituisce un DataFrame.
+    symbol - Il simbolo del ticker, usato per il nome del file di cache.
+    start, end - Le date del periodo scaricato, usate per il nome del file.
+    cache_dir - La directory dove sono memorizzati i file Parquet.
+    ttl - Validità in secondi del file di cache, None per non farlo mai scadere.
+    """
+    key = "%s_%s_%s" % (symbol, start, end)
+    path = os.path.join(cache_dir, "%s.parquet" % re.sub(r'[^\w.-]', '_', key))
+
+    # Usa il file di cache solo se è ancora valido rispetto al ttl
+    if os.path.exists(path):
+        if ttl is None or time.time() - os.path.getmtime(path) < ttl:
+            return pd.read_parquet(path)
+
+    bars = download()
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_write(path, bars.to_parquet)
+    return bars
@@ -2,6 +2,7 @@
 
 # codice python relativo all'articolo presente su datatrading.info
 
+import bottleneck as bn
 import datetime
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,6 +12,17 @@ from pandas_datareader.data import DataReader
 from backtest.backtest import Strategy, Portfolio
 
 
+def _moving_average(values, window):
+    """
+    Media mobile semplice con bottleneck, NaN finché la finestra non è
+    completa come con rolling().mean(). Con meno valori della finestra
+    restituisce solo NaN, dato che bottleneck non accetta la finestra.
+    """
+    if values.shape[0] < window:
+        return np.full_like(values, np.nan)
+    return bn.move_mean(values, window, min_count=window)
+
+
 class MovingAverageCrossStrategy(Strategy):
     """
     Richiede:
@@ -33,17 +45,21 @@ class MovingAverageCrossStrategy(Strategy):
         per andare long, short o flat (1, -1 o 0).
         """
         signals = pd.DataFrame(index=self.bars.index)
-        signals['signal'] = 0.0
 
         # Crea l'insieme di medie mobili semplici di breve e di
-        # lungo periodo
-        signals['short_mavg'] = self.bars['Close'].rolling(self.short_window).mean()
-        signals['long_mavg'] = self.bars['Close'].rolling(self.long_window).mean()
+        # lungo periodo, con i kernel a finestra mobile di bottleneck
+        close = self.bars['Close'].to_numpy(dtype=np.float64)
+        short_mavg = _moving_average(close, self.short_window)
+        long_mavg = _moving_average(close, self.long_window)
 
         # Crea un "segnale" (investito o non investito) quando la media mobile corta incrocia la media
         # mobile lunga, ma solo per il periodo maggiore della finestra della media mobile più breve
-        signals['signal'][self.short_window:] = np.where(signals['short_mavg'][self.short_window:]
-            > signals['long_mavg'][self.short_window:], 1.0, 0.0)
+        signal = np.where(short_mavg > long_mavg, 1.0, 0.0)
+        signal[:self.short_window] = 0.0
+
+        signals['signal'] = signal
+        signals['short_mavg'] = short_mavg
+        signals['long_mavg'] = long_mavg
 
         # Si calcola la differenza dei segnali per generare gli effettivi ordini di trading
         signals['positions'] = signals['signal'].diff()
@@ -76,14 +92,33 @@ class MarketOnClosePortfolio(Portfolio):
         return positions
 
     def backtest_portfolio(self):
-        portfolio = pd.DataFrame(index=self.signals.index).fillna(0.0)
-        pos_diff = self.positions[self.symbol].diff()
-
-        portfolio['holdings'] = (self.positions[self.symbol] * self.bars['Close'])
-        portfolio['cash'] = self.initial_capital - (pos_diff * self.bars['Close']).cumsum()
-
-        portfolio['total'] = portfolio['cash'] + portfolio['holdings']
-        portfolio['returns'] = portfolio['total'].pct_change()
+        # Lavora direttamente sugli array NumPy delle posizioni e dei
+        # prezzi di chiusura, la prima barra acquista l'intera posizione
+        pos = self.positions[self.symbol].to_numpy(dtype=np.float64)
+        price = self.bars['Close'].to_numpy(dtype=np.float64)
+
+        delta = np.empty_like(pos)
+        delta[0] = pos[0]
+        delta[1:] = pos[1:] - pos[:-1]
+
+        # Come con cumsum di pandas, un prezzo mancante rende NaN solo la
+        # barra corrispondente, senza propagarsi alla liquidità successiva
+        holdings = pos * price
+        trades = delta * price
+        cash = self.initial_capital - np.nancumsum(trades)
+        cash[np.isnan(trades)] = np.nan
+
+        total = cash + holdings
+        returns = np.empty_like(total)
+        returns[0] = np.nan
+        returns[1:] = total[1:] / total[:-1] - 1.0
+
+        portfolio = pd.DataFrame({
+            'holdings': holdings,
+            'cash': cash,
+            'total': total,
+            'returns': returns
+        }, index=self.signals.index)
         return portfolio
 
 
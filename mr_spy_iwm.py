@@ -1,17 +1,56 @@
 # mr_spy_iwm.py
 
+import bottleneck as bn
+from dataclasses import dataclass
+from functools import partial
 import matplotlib.pyplot as plt
+import multiprocessing as mp
 import numpy as np
 import os, os.path
 import pandas as pd
 import seaborn as sns
-
-import statsmodels.api as sm
-from statsmodels.regression.rolling import RollingOLS
+from numba import njit
 
 sns.set_style("darkgrid")
 
 
+def csv_to_parquet(datadir, symbols):
+    """
+    Converte i file CSV OHLCV dei simboli in file Parquet nella stessa
+    directory, con un indice Datetime già tipizzato. La conversione è
+    ripetuta solo quando il CSV è stato modificato dopo il Parquet.
+
+    Parameters
+    ----------
+    datadir : `str`
+        Directory dove sono archiviati file CSV che contengono i dati OHLCV.
+    symbols : `tup`
+        Tuple contenente i simboli ticker come `str`.
+    """
+    # Apre i file CSV individualmente e legge il contenuto in un DataFrames pandas
+    # usando la prima colonna come un indice e col_names per gli headers
+    col_names = ['datetime', 'open', 'high', 'low', 'close', 'volume', 'na']
+    for symbol in symbols:
+        csv_path = os.path.join(datadir, '%s.csv' % symbol)
+        path = os.path.join(datadir, '%s.parquet' % symbol)
+
+        # Riconverte il file solo se il CSV è più recente del Parquet
+        if os.path.exists(path) and (
+            not os.path.exists(csv_path)
+            or os.path.getmtime(csv_path) <= os.path.getmtime(path)
+        ):
+            continue
+        print("Converting %s CSV data to Parquet..." % symbol)
+        bars = pd.read_csv(
+            csv_path,
+            header=0,
+            index_col=0,
+            names=col_names
+        )
+        bars.index = pd.to_datetime(bars.index)
+        bars.to_parquet(path)
+
+
 def create_pairs_dataframe(datadir, symbols):
     """
     Crea un DataFrame pandas che contiene i prezzi di chiusura di una
@@ -31,82 +70,246 @@ def create_pairs_dataframe(datadir, symbols):
         Un DataFrame contanente i prezzi di chiusura per SPY e IWM. L'indice è un
         oggetto Datetime.
     """
-    # Apre i file CSV individualmente e legge il contenuto in un DataFrames pandas
-    # usando la prima colonna come un indice e col_names per gli headers
-
-    print("Importing CSV data...")
-    col_names = ['datetime', 'open', 'high', 'low', 'close', 'volume', 'na']
-    sym1 = pd.read_csv(
-        os.path.join(datadir, '%s.csv' % symbols[0]),
-        header=0,
-        index_col=0,
-        names=col_names
-    )
-    sym2 = pd.read_csv(
-        os.path.join(datadir, '%s.csv' % symbols[1]),
-        header=0,
-        index_col=0,
-        names=col_names
-    )
+    # I CSV sono convertiti in Parquet alla prima esecuzione, in seguito
+    # si legge solo la colonna 'close' dal formato colonnare
+    csv_to_parquet(datadir, symbols)
+
+    print("Importing Parquet data...")
+    closes = [
+        pd.read_parquet(
+            os.path.join(datadir, '%s.parquet' % symbol), columns=['close']
+        )['close'].rename('%s_close' % symbol.lower())
+        for symbol in symbols
+    ]
 
     # Crea un DataFrame pandas con i prezzi di chiusura per ogni simbolo
     # correttamente allineate e elimenanto gli elementi mancanti
     print("Constructing dual matrix for %s and %s..." % symbols)
-    pairs = pd.DataFrame(index=sym1.index)
-    pairs['%s_close' % symbols[0].lower()] = sym1['close']
-    pairs['%s_close' % symbols[1].lower()] = sym2['close']
-    pairs.index = pd.to_datetime(pairs.index)
+    pairs = pd.concat(closes, axis=1, join='inner')
     pairs = pairs.dropna()
     return pairs
 
 
+def _regression_prefix_sums(x, y):
+    """
+    Calcola le somme cumulate (con uno zero iniziale) di x, y, x*x e x*y,
+    da cui si ottengono le somme su qualsiasi finestra mobile con una
+    sola sottrazione. Le serie sono prima centrate sulla loro media, che
+    non cambia la pendenza della regressione ma riduce gli errori di
+    cancellazione numerica nelle somme cumulate.
+
+    Parameters
+    ----------
+    x, y : `np.ndarray`
+        Prezzi di chiusura del regressore e della variabile dipendente.
+
+    Returns
+    -------
+    prefix_sums : `tup`
+        Le quattro somme cumulate, ognuna di lunghezza len(x) + 1.
+    """
+    x = x - x.mean()
+    y = y - y.mean()
+    return tuple(
+        np.concatenate(([0.0], np.cumsum(values)))
+        for values in (x, y, x * x, x * y)
+    )
+
+
+@dataclass
+class PairState:
+    """
+    Stato della strategia sulla coppia di simboli, memorizzato come
+    insieme di array NumPy paralleli (uno per grandezza) che condividono
+    lo stesso indice Datetime. Le funzioni del backtest si scambiano
+    questo oggetto e il DataFrame è costruito solo per la visualizzazione.
+
+    Attributes
+    ----------
+    index : `pd.DatetimeIndex`
+        L'indice temporale delle barre.
+    close1, close2 : `np.ndarray`
+        Prezzi di chiusura del primo e del secondo simbolo.
+    hedge_ratio, spread, zscore : `np.ndarray`
+        Hedge ratio mobile, spread e relativo z-score.
+    longs, shorts, exits : `np.ndarray`
+        Segnali `int8` di entrata long, short e di uscita.
+    long_market, short_market : `np.ndarray`
+        Stato di mercato long/short propagato in avanti.
+    prefix_sums : `tup`
+        Somme cumulate di x, y, x*x e x*y usate dalla regressione mobile,
+        calcolate una sola volta per i prezzi di partenza.
+    """
+    index: pd.DatetimeIndex
+    close1: np.ndarray
+    close2: np.ndarray
+    hedge_ratio: np.ndarray = None
+    spread: np.ndarray = None
+    zscore: np.ndarray = None
+    longs: np.ndarray = None
+    shorts: np.ndarray = None
+    exits: np.ndarray = None
+    long_market: np.ndarray = None
+    short_market: np.ndarray = None
+    prefix_sums: tuple = None
+
+    @classmethod
+    def from_dataframe(cls, pairs, symbols):
+        """
+        Crea lo stato a partire dal DataFrame dei prezzi di chiusura
+        restituito da `create_pairs_dataframe`.
+        """
+        close1 = pairs['%s_close' % symbols[0].lower()].to_numpy(dtype=np.float64)
+        close2 = pairs['%s_close' % symbols[1].lower()].to_numpy(dtype=np.float64)
+        return cls(
+            index=pairs.index,
+            close1=close1,
+            close2=close2,
+            prefix_sums=_regression_prefix_sums(close2, close1)
+        )
+
+    def to_dataframe(self, symbols):
+        """
+        Costruisce un DataFrame con tutte le grandezze già calcolate,
+        usando i nomi di colonna della versione basata su pandas.
+        """
+        columns = {
+            '%s_close' % symbols[0].lower(): self.close1,
+            '%s_close' % symbols[1].lower(): self.close2
+        }
+        for name in (
+            'hedge_ratio', 'spread', 'zscore', 'longs', 'shorts',
+            'exits', 'long_market', 'short_market'
+        ):
+            value = getattr(self, name)
+            if value is not None:
+                columns[name] = value
+        return pd.DataFrame(columns, index=self.index)
+
+
 def calculate_spread_zscore(pairs, symbols, lookback=100):
     """
     Crea un hedge ratio tra i due simboli calcolando una regressione
     lineare mobile con uno specifico periodo di lookback. Questa è
     usata per creare uno z-score dello 'spread' tra i due simboli
-    basato da una combinazione lineare dei due.
+    basato da una combinazione lineare dei due, normalizzato con media
+    e deviazione standard mobili sullo stesso periodo di lookback.
 
     Parameters
     ----------
-    pairs : `pd.DataFrame`
-        Un DataFrame contanente i prezzi di chiusura per SPY e IWM. L'indice è un
-        oggetto Datetime.
+    pairs : `PairState`
+        Lo stato contenente i prezzi di chiusura per SPY e IWM.
     symbols : `tup`
         Tuple contenente i simboli ticker come `str`.
     lookback : `int`, optional (default: 100)
-        Periodo di Lookback per la regressione lineare mobile.
+        Periodo di Lookback per la regressione lineare mobile e lo z-score.
 
     Returns
     -------
-    pairs : 'pd.DataFrame'
-        Aggiornamento del DataFrame con lo spred e lo z score tra i
-        due simboli basati sulla regressione lineare mobile.
+    pairs : `PairState`
+        Un nuovo stato con lo spred e lo z score tra i due simboli
+        basati sulla regressione lineare mobile. Lo stato di
+        partenza non è modificato.
     """
 
-    # Uso del metodo Rolling Ordinary Least Squares di statsmodels per allenare
-    # una regressione lineare mobile tra le due serie temporali dei prezzi di chiusura
+    # La regressione lineare mobile tra le due serie temporali dei prezzi di
+    # chiusura ha un solo regressore (più la costante), quindi la pendenza ha
+    # la forma chiusa beta = (w*Sxy - Sx*Sy) / (w*Sxx - Sx^2). Le somme mobili
+    # di x, y, x*x e x*y sono differenze delle somme cumulate, calcolate una
+    # sola volta per tutti i lookback della sweep
     print("Fitting the rolling Linear Regression...")
-
-    model = RollingOLS(
-        endog=pairs['%s_close' % symbols[0].lower()],
-        exog=sm.add_constant(pairs['%s_close' % symbols[1].lower()]),
-        window=lookback
+    x = pairs.close2
+    y = pairs.close1
+    prefix_sums = pairs.prefix_sums
+    if prefix_sums is None:
+        prefix_sums = _regression_prefix_sums(x, y)
+    sx, sy, sxx, sxy = (
+        csum[lookback:] - csum[:-lookback] for csum in prefix_sums
     )
-    rres = model.fit()
-    params = rres.params.copy()
+    hedge_ratio = np.full(x.shape[0], np.nan)
+    hedge_ratio[lookback - 1:] = (lookback * sxy - sx * sy) / (lookback * sxx - sx * sx)
 
-    # Costruzione del hedge ratio ed eliminazione del primo elemento della
-    # finestra di lookbackand vuoto/NaN
-    pairs['hedge_ratio'] = params['iwm_close']
-    pairs.dropna(inplace=True)
+    # Eliminazione del primo elemento della finestra di lookback vuoto/NaN
+    valid = ~np.isnan(hedge_ratio)
+    hedge_ratio = hedge_ratio[valid]
+    x = x[valid]
+    y = y[valid]
 
     # Crea uno spread e quindi uno z-score dello spread
     print("Creating the spread/zscore columns...")
-    pairs['spread'] = (pairs['spy_close'] - pairs['hedge_ratio'] * pairs['iwm_close'])
-    pairs['zscore'] = (pairs['spread'] - np.mean(pairs['spread'])) / np.std(pairs['spread']
-                                                                                   )
-    return pairs
+    spread = y - hedge_ratio * x
+
+    # Media e deviazione standard sono mobili sullo stesso periodo di
+    # lookback, in modo da non usare informazioni future (look-ahead bias),
+    # e lo z-score è poi ottenuto in place sullo stesso buffer. Con meno
+    # barre del lookback nessuna finestra è completa (e bottleneck non
+    # accetta la finestra), quindi lo z-score è interamente NaN
+    if spread.shape[0] >= lookback:
+        mean = bn.move_mean(spread, lookback)
+        std = bn.move_std(spread, lookback, ddof=1)
+    else:
+        mean = std = np.full_like(spread, np.nan)
+    zscore = np.subtract(spread, mean)
+    zscore /= std
+    return PairState(
+        index=pairs.index[valid],
+        close1=y,
+        close2=x,
+        hedge_ratio=hedge_ratio,
+        spread=spread,
+        zscore=zscore
+    )
+
+
+@njit(cache=True, fastmath=True)
+def _propagate_market_state(longs, shorts, exits):
+    """
+    Propaga in avanti lo stato di mercato long/short a partire dai
+    segnali di entrata e di uscita, con un singolo passaggio sulle barre.
+
+    Parameters
+    ----------
+    longs : `np.ndarray`
+        Array `int8` con 1 nelle barre in cui entrare long.
+    shorts : `np.ndarray`
+        Array `int8` con 1 nelle barre in cui entrare short.
+    exits : `np.ndarray`
+        Array `int8` con 1 nelle barre in cui uscire dal mercato.
+
+    Returns
+    -------
+    long_market, short_market : `tup`
+        Array `float64` pari a 1.0 quando si è long/short nella barra, altrimenti 0.0.
+    """
+    n = longs.shape[0]
+    long_market = np.zeros(n, dtype=np.float64)
+    short_market = np.zeros(n, dtype=np.float64)
+
+    # Queste variabili tracciano se essere long o short
+    # durante l'iterazione tra le barre
+    in_long = 0.0
+    in_short = 0.0
+    for i in range(n):
+        # Calcola i long
+        if longs[i] == 1:
+            in_long = 1.0
+        # Calcola gli short
+        if shorts[i] == 1:
+            in_short = 1.0
+        # Calcola le uscite
+        if exits[i] == 1:
+            in_long = 0.0
+            in_short = 0.0
+        long_market[i] = in_long
+        short_market[i] = in_short
+    return long_market, short_market
+
+
+# Compila il kernel all'import (o lo carica dalla cache su disco) in modo
+# che le esecuzioni della sweep dei lookback non paghino la compilazione
+_propagate_market_state(
+    np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int8)
+)
 
 
 def create_long_short_market_signals(pairs, symbols, z_entry_threshold=2.0, z_exit_threshold=1.0):
@@ -117,8 +320,8 @@ def create_long_short_market_signals(pairs, symbols, z_entry_threshold=2.0, z_ex
 
     Parameters
     ----------
-    pairs : `pd.DataFrame`
-        DataFrame aggiornato contenente il prezzo di chiusura, lo spread
+    pairs : `PairState`
+        Stato aggiornato contenente il prezzo di chiusura, lo spread
         e il punteggio z tra i due simboli.
     symbols : `tup`
         Tupla contenente simboli ticker come `str`.
@@ -129,47 +332,26 @@ def create_long_short_market_signals(pairs, symbols, z_entry_threshold=2.0, z_ex
 
     Returns
     -------
-    pairs : `pd.DataFrame`
-        DataFrame aggiornato contenente segnali long, short e di uscita
+    pairs : `PairState`
+        Stato aggiornato contenente segnali long, short e di uscita
     """
 
     # Calcola quando essere long, short e quando uscire
-    pairs['longs'] = (pairs['zscore'] <= -z_entry_threshold)*1.0
-    pairs['shorts'] = (pairs['zscore'] >= z_entry_threshold)*1.0
-    pairs['exits'] = (np.abs(pairs['zscore']) <= z_exit_threshold)*1.0
+    zscore = pairs.zscore
+    pairs.longs = (zscore <= -z_entry_threshold).astype(np.int8)
+    pairs.shorts = (zscore >= z_entry_threshold).astype(np.int8)
+    pairs.exits = (np.abs(zscore) <= z_exit_threshold).astype(np.int8)
 
     # Questi segnali sono necessari perché dobbiamo propagare
     # una posizione in avanti, ovvero dobbiamo rimanere long se
     # la soglia zscore è inferiore a z_entry_threshold di ancora
     # maggiore di z_exit_threshold, e viceversa per short.
-    pairs['long_market'] = 0.0
-    pairs['short_market'] = 0.0
-
-    # Queste variabili tracciano se essere long o short
-    # durante l'iterazione tra le barre
-    long_market = 0
-    short_market = 0
-
-    # Poiché utilizza iterrows per eseguire il loop su un dataframe,
-    # sarà significativamente meno efficiente di un'operazione vettorializzata,
-    # cioè più lenta!
+    # La propagazione è sequenziale, quindi è eseguita da un kernel
+    # compilato con numba sugli array NumPy invece che con iterrows.
     print("Calculating when to be in the market (long and short)...")
-    for i, b in enumerate(pairs.iterrows()):
-        # Calcola i long
-        if b[1]['longs'] == 1.0:
-            long_market = 1
-        # Calcola gli short
-        if b[1]['shorts'] == 1.0:
-            short_market = 1
-        # Calcola le uscite
-        if b[1]['exits'] == 1.0:
-            long_market = 0
-            short_market = 0
-
-        # Assegna direttamente un 1 o 0 alle colonne long_market/short_market,
-        # in modo tale che la strategia sappia quando effettivamente entrare!
-        pairs.iloc[i]['long_market'] = long_market
-        pairs.iloc[i]['short_market'] = short_market
+    pairs.long_market, pairs.short_market = _propagate_market_state(
+        pairs.longs, pairs.shorts, pairs.exits
+    )
     return pairs
 
 
@@ -182,8 +364,8 @@ def create_portfolio_returns(pairs, symbols):
 
     Parameters
     ----------
-    pairs : `pd.DataFrame`
-        DataFrame aggiornato contenente il prezzo di chiusura, lo spread
+    pairs : `PairState`
+        Stato aggiornato contenente il prezzo di chiusura, lo spread
         e il punteggio z tra i due simboli e i segnali long, short e uscita.
     symbols : `tup`
         Tupla contenente simboli ticker come `str`.
@@ -191,7 +373,7 @@ def create_portfolio_returns(pairs, symbols):
     Returns
     -------
     portfolio : 'pd.DataFrame'
-        Un DataFrame con l'indice datetime del DataFrame dei pairs, le posizioni,
+        Un DataFrame con l'indice datetime dello stato dei pairs, le posizioni,
         il valore di mercato totale e rendimenti.
     """
 
@@ -199,57 +381,103 @@ def create_portfolio_returns(pairs, symbols):
     sym1 = symbols[0].lower()
     sym2 = symbols[1].lower()
 
-    # Crea l'oggetto portfolio con le informazioni sulle posizioni
+    # Calcola le posizioni e il valore di mercato sugli array
     # Notare la sottrazione per tenere traccia degli short!
     print("Constructing a portfolio...")
-    portfolio = pd.DataFrame(index=pairs.index)
-    portfolio['positions'] = pairs['long_market'] - pairs['short_market']
-    portfolio[sym1] = -1.0 * pairs['%s_close' % sym1] * portfolio['positions']
-    portfolio[sym2] = pairs['%s_close' % sym2] * portfolio['positions']
-    portfolio['total'] = portfolio[sym1] + portfolio[sym2]
-
-    # Crea un flusso di rendimenti percentuali ed elimina
-    # tutte le celle NaN e -inf/+inf
+    positions = pairs.long_market - pairs.short_market
+    value1 = -1.0 * pairs.close1 * positions
+    value2 = pairs.close2 * positions
+    total = value1 + value2
+
+    # Crea un flusso di rendimenti percentuali ed elimina con un'unica
+    # maschera tutte le celle NaN, -inf/+inf e i rendimenti esattamente
+    # pari a -1 (che azzererebbero l'intera curva di equity)
     print("Constructing the equity curve...")
-    portfolio['returns'] = portfolio['total'].pct_change()
-    portfolio['returns'].fillna(0.0, inplace=True)
-    portfolio['returns'].replace([np.inf, -np.inf], 0.0, inplace=True)
-    portfolio['returns'].replace(-1.0, 0.0, inplace=True)
+    returns = np.zeros_like(total)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns[1:] = total[1:] / total[:-1] - 1.0
+    returns = np.where(np.isfinite(returns) & (returns != -1.0), returns, 0.0)
+
+    # Calcola la curva di equity come esponenziale della somma cumulata
+    # dei log-rendimenti, numericamente più stabile del prodotto cumulato.
+    # I rendimenti minori di -1 (quando 'total' cambia segno) invertono il
+    # segno della curva, come nel prodotto cumulato, quindi si accumulano
+    # i logaritmi dei fattori in valore assoluto e separatamente il segno
+    growth = 1.0 + returns
+    sign = np.where(np.cumsum(growth < 0.0) % 2 == 1, -1.0, 1.0)
+    equity = sign * np.exp(np.log(np.abs(growth)).cumsum())
+
+    # Crea il DataFrame del portafoglio in un'unica allocazione
+    return pd.DataFrame({
+        'positions': positions,
+        sym1: value1,
+        sym2: value2,
+        'total': total,
+        'returns': equity
+    }, index=pairs.index)
+
+
+def run_one_lookback(lookback, pairs_base, symbols):
+    """
+    Esegue l'intero backtest della coppia per un singolo periodo di
+    lookback. È una funzione di modulo in modo da poter essere
+    distribuita sui processi di un `multiprocessing.Pool`.
+
+    Parameters
+    ----------
+    lookback : `int`
+        Periodo di Lookback per la regressione lineare mobile.
+    pairs_base : `PairState`
+        Stato contenente i prezzi di chiusura dei due simboli.
+    symbols : `tup`
+        Tupla contenente simboli ticker come `str`.
+
+    Returns
+    -------
+    returns : `float`
+        Valore finale della curva di equity.
+    """
+    print("Calculating lookback=%s..." % lookback)
+    pairs = calculate_spread_zscore(pairs_base, symbols, lookback=lookback)
+    pairs = create_long_short_market_signals(
+        pairs, symbols, z_entry_threshold=2.0, z_exit_threshold=1.0
+    )
+    portfolio = create_portfolio_returns(pairs, symbols)
+    return portfolio.iloc[-1]['returns']
 
-    # Calcola la curva di equity
-    portfolio['returns'] = (portfolio['returns'] + 1.0).cumprod()
-    return portfolio
 
 if __name__ == "__main__":
     datadir = '/your/path/to/data/'  # Da modificare
     symbols = ('SPY', 'IWM')
 
     lookbacks = range(50, 210, 10)
-    returns = []
+
+    # I prezzi sono letti una sola volta, ogni lookback crea
+    # un nuovo stato senza modificare quello di partenza
+    pairs_base = PairState.from_dataframe(
+        create_pairs_dataframe(datadir, symbols), symbols
+    )
 
     # Regola il periodo di ricerca da 50 a 200 con
-    # incrementi di 10 per produrre sensibilità
-    for lb in lookbacks:
-        print("Calculating lookback=%s..." % lb)
-        pairs = create_pairs_dataframe(datadir, symbols)
-        pairs = calculate_spread_zscore(pairs, symbols, lookback=lb)
-        pairs = create_long_short_market_signals(
-            pairs, symbols, z_entry_threshold=2.0, z_exit_threshold=1.0
+    # incrementi di 10 per produrre sensibilità. I backtest
+    # sono indipendenti, quindi sono eseguiti in parallelo
+    with mp.Pool() as pool:
+        returns = pool.map(
+            partial(run_one_lookback, pairs_base=pairs_base, symbols=symbols),
+            lookbacks
         )
-        portfolio = create_portfolio_returns(pairs, symbols)
-        returns.append(portfolio.iloc[-1]['returns'])
 
     print("Plot the lookback-performance scatterchart...")
     plt.plot(lookbacks, returns, '-o')
     plt.show()
 
     # Questo è ancora nella funzione main
-    pairs = create_pairs_dataframe(datadir, symbols)
-    pairs = calculate_spread_zscore(pairs, symbols, lookback=100)
+    pairs = calculate_spread_zscore(pairs_base, symbols, lookback=100)
     pairs = create_long_short_market_signals(
         pairs, symbols, z_entry_threshold=2.0, z_exit_threshold=1.0
     )
     portfolio = create_portfolio_returns(pairs, symbols)
+    pairs = pairs.to_dataframe(symbols)
 
     print("Plotting the performance charts...")
     fig = plt.figure()
@@ -3,10 +3,37 @@
 # performance.py
 
 import numpy as np
-import pandas as pd
+from numba import njit
 
 # performance.py
 
+@njit
+def _mean_std(returns):
+    """
+    Calcola media e deviazione standard (ddof=0, come np.std) con
+    un singolo passaggio di Welford, ignorando gli elementi NaN.
+
+    Parametri:
+    returns - Un array NumPy float64 dei rendimenti percentuali.
+
+    Restituisce:
+    Mean, std - Media e deviazione standard dei rendimenti.
+    """
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    for x in returns:
+        if np.isnan(x):
+            continue
+        n += 1
+        delta = x - mean
+        mean += delta / n
+        m2 += delta * (x - mean)
+    if n == 0:
+        return np.nan, np.nan
+    return mean, np.sqrt(m2 / n)
+
+
 def create_sharpe_ratio(returns, periods=252):
     """
     Crea il Sharpe ratio per la strategia, basato su a benchmark
@@ -16,7 +43,39 @@ def create_sharpe_ratio(returns, periods=252):
     returns - Una serie panda che rappresenta i rendimenti percentuali nel periodo.
     periods - Giornaliero (252), orario (252 * 6,5), minuto (252 * 6,5 * 60) ecc.
     """
-    return np.sqrt(periods) * (np.mean(returns)) / np.std(returns)
+    mean, std = _mean_std(np.asarray(returns, dtype=np.float64))
+    return np.sqrt(periods) * mean / std
+
+
+@njit
+def _max_drawdown_duration(equity):
+    """
+    Calcola in un singolo passaggio il massimo drawdown e la massima
+    durata del drawdown di un array di equity.
+
+    Parametri:
+    equity - Un array NumPy float64 che rappresenta la curva di equity.
+
+    Restituisce:
+    Drawdown, duration - Massimo drawdown picco-minimo e relativa durata.
+    """
+    n = equity.shape[0]
+    if n < 2:
+        return np.nan, np.nan
+    hwm = 0.0
+    duration = 0.0
+    max_drawdown = -np.inf
+    max_duration = -np.inf
+    for t in range(1, n):
+        if equity[t] > hwm:
+            hwm = equity[t]
+        drawdown = hwm - equity[t]
+        duration = 0.0 if drawdown == 0 else duration + 1.0
+        if drawdown > max_drawdown:
+            max_drawdown = drawdown
+        if duration > max_duration:
+            max_duration = duration
+    return max_drawdown, max_duration
 
 
 def create_drawdowns(equity_curve):
@@ -32,18 +91,7 @@ def create_drawdowns(equity_curve):
     Drawdown, duration - Massimo drawdown picco-minimo e relativa durata.
     """
 
-    # Calcola la curva cumulativa dei rendimenti
-    # e imposta un "High Water Mark"
-    # Quindi crea le serie dei drawdown e relative durate
-    hwm = [0]
-    eq_idx = equity_curve.index
-    drawdown = pd.Series(index = eq_idx)
-    duration = pd.Series(index = eq_idx)
-
-    # Loop over the index range
-    for t in range(1, len(eq_idx)):
-        cur_hwm = max(hwm[t-1], equity_curve[t])
-        hwm.append(cur_hwm)
-        drawdown[t]= hwm[t] - equity_curve[t]
-        duration[t]= 0 if drawdown[t] == 0 else duration[t-1] + 1
-    return drawdown.max(), duration.max()
\ No newline at end of file
+    # Calcola la curva cumulativa dei rendimenti e imposta un
+    # "High Water Mark", quindi i drawdown e le relative durate,
+    # con un unico passaggio compilato sull'array dei valori
+    return _max_drawdown_duration(np.asarray(equity_curve, dtype=np.float64))
\ No newline at end of file
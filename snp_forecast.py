@@ -4,19 +4,103 @@
 # https://datatrading.info/strategia-di-forecasting-sul-sp500-backtesting-con-python-e-pandas/
 
 import datetime
-import matplotlib.pyplot as plt
+import functools
+import hashlib
+import joblib
 import numpy as np
+import os
 import pandas as pd
-import sklearn
 
 import pandas_datareader as pdr
-from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis as QDA
+from numba import njit
+from threadpoolctl import threadpool_limits
 
 from backtest.backtest import Strategy, Portfolio
+from data.cache import atomic_write, cached_download
 from model.forecast import create_lagged_series
 
 # snp_forecast.py
 
+# Cache su disco della serie ritardata e dei modelli allenati, in modo che
+# le esecuzioni successive con gli stessi input non ripetano il download
+# dei dati e l'allenamento del QDA
+CACHE_DIR = '.cache'
+memory = joblib.Memory(location=CACHE_DIR, verbose=0)
+cached_lagged_series = memory.cache(create_lagged_series)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_lagged(symbol, start_train_iso, end_period_iso, lags):
+    """
+    Restituisce la serie ritardata di un simbolo per il periodo indicato,
+    memorizzata in RAM per tutta l'esecuzione: una ricerca che cambia
+    solo la data di inizio del test riusa lo stesso DataFrame senza
+    rileggere la cache su disco. Le date sono stringhe ISO in modo che
+    la chiave sia hashable e indipendente dal tipo di data passato.
+    Il DataFrame restituito è condiviso e non deve essere modificato.
+    """
+    return cached_lagged_series(
+        symbol,
+        datetime.datetime.fromisoformat(start_train_iso),
+        datetime.datetime.fromisoformat(end_period_iso),
+        lags=lags
+    )
+
+
+def _qda_fit(X, y):
+    """
+    Allena un Quadratic Discriminant Analyser con NumPy, senza la
+    validazione degli input di scikit-learn che per 2 classi e 2
+    feature domina il tempo di allenamento. Restituisce le classi
+    ordinate e, per ogni classe, la media, l'inversa della matrice di
+    covarianza, il logaritmo del suo determinante e la probabilità a
+    priori. La covarianza è quella di massima verosimiglianza, divisa
+    per il numero di campioni della classe, la stessa normalizzazione
+    del solver 'svd' di QuadraticDiscriminantAnalysis con reg_param=0.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    classes = np.unique(y)
+    params = []
+    for k in classes:
+        Xk = X[y == k]
+        mu = Xk.mean(axis=0)
+        S = np.cov(Xk, rowvar=False, bias=True)
+        params.append((mu, np.linalg.inv(S), np.linalg.slogdet(S)[1], Xk.shape[0] / X.shape[0]))
+    return classes, params
+
+
+def fit_cached_qda(X_train, y_train, cache_dir=CACHE_DIR):
+    """
+    Restituisce le classi e i parametri del QDA allenato sui dati di
+    training, leggendoli da disco se il modello è già stato allenato
+    sugli stessi dati, altrimenti lo allena e lo salva con una chiave
+    ricavata dal contenuto degli array.
+    """
+    key = hashlib.blake2b(X_train.tobytes() + y_train.tobytes()).hexdigest()
+    path = os.path.join(cache_dir, 'qda_mle_%s.pkl' % key)
+    if os.path.exists(path):
+        return joblib.load(path)
+
+    # Il file è scritto atomicamente: i processi paralleli di `sweep`
+    # allenano lo stesso modello e non devono leggere un pickle incompleto
+    model = _qda_fit(X_train, y_train)
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_write(path, lambda tmp: joblib.dump(model, tmp))
+    return model
+
+
+def bars_arrays(bars):
+    """
+    Estrae una sola volta dal DataFrame delle barre gli array NumPy dei
+    prezzi di apertura e chiusura, usati dal portafoglio per tutti i
+    calcoli successivi.
+    """
+    return (
+        bars['Open'].to_numpy(dtype=np.float64),
+        bars['Close'].to_numpy(dtype=np.float64)
+    )
+
+
 class SNPForecastingStrategy(Strategy):
     """
     Richiede:
@@ -27,6 +111,7 @@ class SNPForecastingStrategy(Strategy):
     def __init__(self, symbol, bars):
         self.symbol = symbol
         self.bars = bars
+        self._idx = bars.index
         self.create_periods()
         self.fit_model()
 
@@ -41,46 +126,153 @@ class SNPForecastingStrategy(Strategy):
         Applica il Quadratic Discriminant Analyser al indice
         del mercato azionario US (^GPSC in Yahoo).
         """
-        # Crea la serie ritardata dell'indice S&P500 del mercato azionario US
-        snpret = create_lagged_series(self.symbol, self.start_train, self.end_period, lags=5)
-
-        # Usa i rendimenti dei 2 giorni precedenti come
-        # valori di predizione, con la direzione come risposta
-        X = snpret[["Lag1","Lag2"]]
-        y = snpret["Direction"]
-
-        # Crea i dataset di training e di test
-        X_train = X[X.index < self.start_test]
-        y_train = y[y.index < self.start_test]
-
-        # Crea i fattori di predizioni per usare
-        # la direzione predetta
-        self.predictors = X[X.index >= self.start_test]
+        # Crea la serie ritardata dell'indice S&P500 del mercato azionario US,
+        # che dipende solo dal simbolo e dal periodo e non dalla separazione
+        # tra training e test
+        snpret = _load_lagged(
+            self.symbol, self.start_train.isoformat(), self.end_period.isoformat(), 5
+        )
+
+        # Usa i rendimenti dei 2 giorni precedenti come valori di
+        # predizione, con la direzione come risposta. I fattori sono
+        # convertiti una sola volta in un buffer float32 in ordine di
+        # colonna (Fortran), in modo che le operazioni per feature del
+        # modello lavorino su memoria contigua. La precisione singola è
+        # sufficiente per rendimenti giornalieri e dimezza i byte letti
+        # durante il calcolo dei punteggi
+        self._lagged_buf = np.asfortranarray(
+            snpret[["Lag1","Lag2"]].to_numpy(), dtype=np.float32
+        )
+        y = snpret["Direction"].to_numpy()
+
+        # L'indice è ordinato, quindi la separazione tra training e test
+        # è una sola posizione trovata con una ricerca binaria
+        split = snpret.index.searchsorted(self.start_test)
+
+        # I fattori di predizione del periodo di test sono una vista del
+        # buffer, senza copie, riusata da ogni chiamata di generate_signals
+        self.predictors = self._lagged_buf[split:]
 
         # Crea il modello di Quadratic Discriminant Analysis
-        # e la strategia previsionale
-        self.model = QDA()
-        self.model.fit(X_train, y_train)
+        # e la strategia previsionale sul dataset di training
+        X_train = self._lagged_buf[:split]
+        y_train = y[:split]
+        self.classes, self.qda_params = fit_cached_qda(X_train, y_train)
+        self._prepare_fast_predict()
+
+    def _prepare_fast_predict(self):
+        """
+        Precalcola per ogni classe del QDA allenato la matrice di
+        whitening W_k, fattore di Cholesky di inv(Sigma_k), la media e
+        la costante 0.5*log|Sigma_k| - log(pi_k), in precisione singola.
+        Le matrici sono impilate in un unico tensore (K, d, d) contiguo,
+        in modo da valutare la distanza di Mahalanobis di tutto il
+        periodo di test e di tutte le classi con una sola einsum.
+        """
+        mus, invs, logdets, priors = zip(*self.qda_params)
+        self._W = np.ascontiguousarray(
+            np.stack([np.linalg.cholesky(inv) for inv in invs]), dtype=np.float32
+        )
+        self._mu = np.array(mus, dtype=np.float32)
+        self._c = np.array([
+            0.5 * logdet - np.log(p) for logdet, p in zip(logdets, priors)
+        ], dtype=np.float32)
+
+        # Con 2 classi e 2 feature la frontiera di decisione è una sola
+        # forma quadratica nella differenza delle funzioni discriminanti
+        # delta_k(x) = x'A_k x + b_k'x + c_k, con A_k = -0.5*inv(Sigma_k),
+        # b_k = inv(Sigma_k) mu_k e c_k = -0.5*mu_k' inv(Sigma_k) mu_k
+        # - 0.5*log|Sigma_k| + log(pi_k). Il suo segno indica la classe.
+        self._quad = None
+        if len(self.classes) == 2 and self._mu.shape[1] == 2:
+            A, b, c = [], [], []
+            for mu, inv, logdet, p in self.qda_params:
+                A.append(-0.5 * inv)
+                b.append(inv @ mu)
+                c.append(-0.5 * mu @ inv @ mu - 0.5 * logdet + np.log(p))
+            dA = A[1] - A[0]
+            db = b[1] - b[0]
+            self._quad = np.array([
+                dA[0, 0], 2.0 * dA[0, 1], dA[1, 1], db[0], db[1], c[1] - c[0]
+            ], dtype=np.float32)
+
+    def _fast_predict(self, X):
+        """
+        Restituisce la classe predetta per ogni riga di X, scegliendo
+        quella con il minimo di 0.5*||(x - mu_k) W_k||^2 + c_k, cioè
+        con la massima funzione discriminante quadratica. Nel caso
+        con 2 classi e 2 feature valuta direttamente il segno della
+        forma quadratica, senza prodotti matriciali.
+        """
+        if self._quad is not None:
+            a11, a12, a22, b1, b2, c = self._quad
+            x1 = X[:, 0]
+            x2 = X[:, 1]
+            q = a11 * x1 * x1 + a12 * x1 * x2 + a22 * x2 * x2 + b1 * x1 + b2 * x2 + c
+            return np.where(q > 0, self.classes[1], self.classes[0])
+
+        diff = X[:, None, :] - self._mu[None, :, :]
+        whitened = np.einsum('nkd,kde->nke', diff, self._W)
+        scores = 0.5 * np.square(whitened).sum(axis=-1) + self._c
+        return self.classes[np.argmin(scores, axis=1)]
 
     def generate_signals(self):
         """
         Restituisce il DataFrame dei simboli che contiene i segnali
         per andare long, short o flat (1, -1 or 0).
         """
-        signals = pd.DataFrame(index=self.bars.index)
-        signals['signal'] = 0.0
-
         # Predizione del periodo successivo con il modello QDA
-        signals['signal'] = self.model.predict(self.predictors)
+        # I segnali {-1, 0, 1} sono memorizzati come int8
+        signal = self._fast_predict(self.predictors).astype(np.int8)
 
         # Rimuove i primi 5 segnali per eliminare gli elementi
         # NaN nel DataFrame dei segnali
-        signals['signal'][0:5] = 0.0
-        signals['positions'] = signals['signal'].diff()
-
+        signal[:5] = 0
+
+        # Le posizioni sono la differenza dei segnali tra barre
+        # consecutive, con il primo elemento NaN come con diff()
+        positions = np.empty(signal.shape[0], dtype=np.float64)
+        positions[0] = np.nan
+        np.subtract(signal[1:], signal[:-1], out=positions[1:])
+
+        signals = pd.DataFrame({
+            'signal': signal,
+            'positions': positions
+        }, index=self._idx, copy=False)
         return signals
 
 
+@njit(cache=True, error_model='numpy')
+def _equity_curve(profit, initial_capital, total, returns):
+    """
+    Calcola in un singolo passaggio la curva equity come capitale
+    iniziale più la somma cumulata dei profitti, e i relativi
+    rendimenti percentuali (il primo è NaN come con pct_change),
+    scrivendoli negli array di uscita 'total' e 'returns'.
+    Come con cumsum di pandas, un profitto NaN produce un totale e un
+    rendimento NaN solo in quella barra, senza propagarsi alle
+    successive, e un capitale nullo produce rendimenti inf o NaN.
+    """
+    n = profit.shape[0]
+    t = initial_capital
+    for i in range(n):
+        if np.isnan(profit[i]):
+            total[i] = np.nan
+            returns[i] = np.nan
+            continue
+        prev = t
+        t += profit[i]
+        total[i] = t
+        returns[i] = (t - prev) / prev
+    if n > 0:
+        returns[0] = np.nan
+
+
+# Prima chiamata su array vuoti, così ogni worker della sweep trova la
+# curva equity già compilata prima del primo backtest_portfolio
+_equity_curve(np.zeros(0), 0.0, np.zeros(0), np.zeros(0))
+
+
 class MarketIntradayPortfolio(Portfolio):
     """
     Acquista o vende 500 azioni di un'asset al prezzo di apertura di
@@ -97,6 +289,7 @@ class MarketIntradayPortfolio(Portfolio):
     def __init__(self, symbol, bars, signals, initial_capital=100000.0):
         self.symbol = symbol
         self.bars = bars
+        self._open, self._close = bars_arrays(bars)
         self.signals = signals
         self.initial_capital = float(initial_capital)
         self.positions = self.generate_positions()
@@ -106,11 +299,11 @@ class MarketIntradayPortfolio(Portfolio):
         Genera il DataFrame delle posizioni, basate sui segnali
         forniti dal DataFrame 'signals'.
         """
-        positions = pd.DataFrame(index=self.signals.index).fillna(0.0)
-
         # Long o short di 500 azioni dello SPY basate sui
-        # segnali direzionali giornalieri
-        positions[self.symbol] = 500 * self.signals['signal']
+        # segnali direzionali giornalieri, come interi int32
+        positions = pd.DataFrame({
+            self.symbol: self.signals['signal'].to_numpy().astype(np.int32) * 500
+        }, index=self.signals.index, copy=False)
         return positions
 
     def backtest_portfolio(self):
@@ -118,31 +311,86 @@ class MarketIntradayPortfolio(Portfolio):
         Backtest del portafoglio e restituisce un DataFrame contenente
         la curva equity e i precentuali dei rendimenti."""
 
-        # Imposta l'oggetto Portfolio per avere lo stesso periodo
-        # del DataFrame delle posizioni
-        portfolio = pd.DataFrame(index=self.positions.index)
-        pos_diff = self.positions.diff()
+        # I prezzi di apertura e chiusura sono già array NumPy,
+        # si estraggono solo le posizioni intere, convertite in
+        # float64 solo nel prodotto con le differenze di prezzo
+        pos = self.positions[self.symbol].to_numpy()
 
         # Calcola il profitto infragiornaliero della differenza tra
         # i prezzi di apertura e chiusura e quindi determina il
         # profitto giornaliero andando long se è previsto un giorno
         # positivo e short se è previsto un giorno negativo
-        portfolio['price_diff'] = self.bars['Close'] - self.bars['Open']
-        portfolio['price_diff'][0:5] = 0.0
-        portfolio['profit'] = self.positions[self.symbol] * portfolio['price_diff']
+        # Le quattro colonne del portafoglio sono scritte direttamente in
+        # un unico blocco float64 in ordine di colonna (Fortran), in modo
+        # che il DataFrame abbia un solo blocco senza copie né
+        # consolidamenti e che ogni colonna sia contigua in memoria
+        block = np.empty((self._open.shape[0], 4), order='F')
+        price_diff, profit, total, returns = block.T
+        np.subtract(self._close, self._open, out=price_diff)
+        price_diff[:5] = 0.0
+        np.multiply(price_diff, pos, out=profit)
 
         # Genera la curva equity e la percentuale dei rendimenti
-        portfolio['total'] = self.initial_capital + portfolio['profit'].cumsum()
-        portfolio['returns'] = portfolio['total'].pct_change()
+        # con un unico passaggio sui profitti
+        _equity_curve(profit, self.initial_capital, total, returns)
+
+        # Crea il DataFrame del portafoglio sul blocco già riempito, con
+        # lo stesso periodo del DataFrame delle posizioni
+        portfolio = pd.DataFrame(
+            block, index=self.positions.index,
+            columns=['price_diff', 'profit', 'total', 'returns'], copy=False
+        )
         return portfolio
 
 
+
+def _run_one(config):
+    """
+    Esegue il backtest completo (strategia e portafoglio) per una
+    singola configurazione e restituisce la curva di equity. Le
+    librerie BLAS/OpenMP sono limitate a un thread, in modo che
+    i processi paralleli di `sweep` non competano per i core.
+    """
+    with threadpool_limits(limits=1):
+        bars = config['bars']
+        strategy = SNPForecastingStrategy(config['symbol'], bars)
+        signals = strategy.generate_signals()
+        portfolio = MarketIntradayPortfolio(
+            config.get('portfolio_symbol', config['symbol']), bars, signals,
+            initial_capital=config.get('initial_capital', 100000.0)
+        )
+        return portfolio.backtest_portfolio()['total']
+
+
+def sweep(configs, n_jobs=-1):
+    """
+    Esegue in parallelo con joblib (backend loky) i backtest di un insieme
+    di configurazioni, ognuna un dict con le chiavi 'symbol' (simbolo
+    della strategia), 'bars' (DataFrame delle barre) e opzionalmente
+    'portfolio_symbol' e 'initial_capital'. Restituisce le curve di
+    equity nello stesso ordine delle configurazioni.
+    """
+    return joblib.Parallel(n_jobs=n_jobs, backend='loky')(
+        joblib.delayed(_run_one)(config) for config in configs
+    )
+
+
 if __name__ == "__main__":
+    # Backend Agg senza interfaccia grafica, selezionato prima di importare
+    # pyplot, in modo da eseguire lo script anche in container e batch
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     start_test = datetime.datetime(2005, 1, 1)
     end_period = datetime.datetime(2005, 12, 31)
 
-    # Download le barre dello ETF SPY che rispecchia l'indice S&P500
-    bars = pdr.DataReader("SPY", "yahoo", start_test, end_period)
+    # Download le barre dello ETF SPY che rispecchia l'indice S&P500,
+    # salvate in un file Parquet locale dopo la prima esecuzione
+    bars = cached_download(
+        lambda: pdr.DataReader("SPY", "yahoo", start_test, end_period),
+        "SPY", start_test.date(), end_period.date()
+    )
 
     # Crea la strategia di previsione dell'S&P500
     snpf = SNPForecastingStrategy("^GSPC", bars)
@@ -165,5 +413,5 @@ if __name__ == "__main__":
     ax2 = fig.add_subplot(212, ylabel='Portfolio value in $')
     returns['total'].plot(ax=ax2, lw=2.)
 
-    fig.show()
-    print("")
\ No newline at end of file
+    # Salva il grafico su file invece di aprire una finestra
+    fig.savefig('snp_forecast.png', dpi=100)
\ No newline at end of file
@@ -0,0 +1,109 @@
+# test_snp_forecast.py
+
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import snp_forecast
+from snp_forecast import _run_one
+
+
+def fake_lagged_series(symbol, start_date, end_date, lags=5):
+    """
+    Serie ritardata sintetica con la stessa struttura di
+    create_lagged_series, senza scaricare dati da Yahoo.
+    """
+    rng = np.random.default_rng(0)
+    index = pd.bdate_range(start_date, end_date)
+    lagged = pd.DataFrame({'Today': rng.standard_normal(len(index))}, index=index)
+    for i in range(lags):
+        lagged['Lag%d' % (i + 1)] = lagged['Today'].shift(i + 1)
+    lagged = lagged.dropna()
+    lagged['Direction'] = np.sign(lagged['Today'])
+    return lagged
+
+
+def fake_bars():
+    index = pd.bdate_range(datetime.datetime(2005, 1, 1), datetime.datetime(2005, 12, 31))
+    return pd.DataFrame({'Open': 100.0, 'Close': 100.5}, index=index)
+
+
+def run_one_offline(config):
+    """
+    Esegue _run_one nel processo worker con la serie ritardata sintetica
+    e con la cache dei modelli nella directory temporanea del test.
+    """
+    os.chdir(config['cwd'])
+    snp_forecast.cached_lagged_series = fake_lagged_series
+    return _run_one(config)
+
+
+def test_sweep_parallel_cold_cache(tmp_path, monkeypatch):
+    # Tutte le configurazioni hanno lo stesso simbolo e quindi lo stesso
+    # modello: i worker scrivono e leggono in parallelo lo stesso pickle
+    monkeypatch.setattr(snp_forecast, '_run_one', run_one_offline)
+    bars = fake_bars()
+    configs = [{'symbol': 'SPY', 'bars': bars, 'cwd': str(tmp_path)} for _ in range(16)]
+
+    totals = snp_forecast.sweep(configs, n_jobs=4)
+
+    assert len(totals) == 16
+    for total in totals[1:]:
+        pd.testing.assert_series_equal(total, totals[0])
+    assert not [f for f in os.listdir(tmp_path / '.cache') if f.endswith('.tmp')]
+
+
+def fitted_strategy(X, y):
+    """
+    Strategia con il QDA allenato su X, y senza passare da fit_model,
+    in modo da confrontare direttamente i parametri e le predizioni.
+    """
+    strategy = snp_forecast.SNPForecastingStrategy.__new__(snp_forecast.SNPForecastingStrategy)
+    strategy.classes, strategy.qda_params = snp_forecast._qda_fit(X, y)
+    strategy._prepare_fast_predict()
+    return strategy
+
+
+@pytest.mark.parametrize('n_classes, n_features', [(2, 2), (3, 3)])
+def test_qda_fit_matches_sklearn(n_classes, n_features):
+    discriminant_analysis = pytest.importorskip('sklearn.discriminant_analysis')
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((300, n_features)) * np.arange(1, n_features + 1)
+    y = rng.integers(0, n_classes, 300)
+
+    strategy = fitted_strategy(X, y)
+    model = discriminant_analysis.QuadraticDiscriminantAnalysis().fit(X, y)
+
+    np.testing.assert_array_equal(strategy.classes, model.classes_)
+    for (mu, inv, logdet, prior), mean, rotation, scaling, model_prior in zip(
+        strategy.qda_params, model.means_, model.rotations_, model.scalings_, model.priors_
+    ):
+        np.testing.assert_allclose(mu, mean)
+        np.testing.assert_allclose(np.linalg.inv(inv), (rotation * scaling) @ rotation.T)
+        np.testing.assert_allclose(logdet, np.log(scaling).sum())
+        assert prior == pytest.approx(model_prior)
+    np.testing.assert_array_equal(
+        strategy._fast_predict(X.astype(np.float32)), model.predict(X)
+    )
+
+
+def test_equity_curve_nan_profit_and_zero_capital():
+    profit = np.array([1.0, np.nan, 2.0, 3.0])
+    total = np.empty(4)
+    returns = np.empty(4)
+    snp_forecast._equity_curve(profit, 100.0, total, returns)
+
+    # Un profitto NaN rende NaN solo il totale e il rendimento della sua barra
+    np.testing.assert_array_equal(total, [101.0, np.nan, 103.0, 106.0])
+    assert np.isnan(returns[0]) and np.isnan(returns[1])
+    np.testing.assert_allclose(returns[2:], [2.0 / 101.0, 3.0 / 103.0])
+
+    # Un capitale azzerato produce un rendimento inf invece di un'eccezione
+    total = np.empty(2)
+    returns = np.empty(2)
+    snp_forecast._equity_curve(np.array([-100.0, 5.0]), 100.0, total, returns)
+    np.testing.assert_array_equal(total, [0.0, 5.0])
+    assert np.isinf(returns[1])